@@ -1,8 +1,5 @@
 from loguru import logger
 import sys
-from app.config import get_app_settings
-
-settings = get_app_settings()
 
 logger.remove()
 logger.add(
@@ -17,7 +14,8 @@ logger.add(
     retention="2 days",
     compression="zip",
     level="INFO",
+    enqueue=True,
     format="{time:DD.MM.YY — HH:mm:ss} | {level} | {file}:{line} | {message}",
 )
 
-__all__ = ["logger", "settings"]
\ No newline at end of file
+__all__ = ["logger"]
\ No newline at end of file
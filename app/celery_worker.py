@@ -1,6 +1,17 @@
+import asyncio
+
 from celery import Celery
 from app.config import get_app_settings
 
+try:
+    # Tasks drive the async clients with asyncio.run(), which picks up the
+    # loop from the policy. uvloop is only installed on Linux.
+    import uvloop
+
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+except ImportError:
+    pass
+
 settings = get_app_settings()
 
 celery_tasks = Celery(
@@ -16,4 +27,19 @@ celery_tasks.conf.update(
     result_serializer="json",
     timezone="UTC",
     enable_utc=True,
+    # Tasks mostly wait on Azure OpenAI, Azure Search and Postgres, so a
+    # thread pool gives I/O concurrency without forking a process per slot
+    worker_pool=settings.celery_pool,
+    worker_concurrency=settings.celery_concurrency,
+    # Uploads take seconds of embedding work, so a worker only takes a task
+    # when it has a free slot and short deletions don't queue behind them
+    worker_prefetch_multiplier=1,
+    # Deletions are idempotent and are redelivered if their worker dies,
+    # uploads opt out in their task options
+    task_acks_late=True,
+    # Deletions stay on the default queue, so they are never stuck behind
+    # long uploads once those have a queue of their own
+    task_routes={
+        "app.tasks.upload_documents_task": {"queue": settings.celery_upload_queue},
+    },
 )
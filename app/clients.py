@@ -1,56 +1,184 @@
-from openai import AsyncOpenAI
-from openai.lib.azure import AsyncAzureOpenAI
+from functools import lru_cache
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+from openai.lib.azure import AsyncAzureOpenAI, AzureOpenAI
 from azure.core.credentials import AzureKeyCredential
+from redis import Redis
 from redis import asyncio as aioredis
-from azure.search.documents import SearchClient
-from sqlmodel import create_engine
+from azure.search.documents.aio import SearchClient
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker
+from sqlmodel import Session, create_engine
 
-from app import settings, logger
+from app import logger
+from app.config import get_app_settings
 
-try:
-    azure_client = AsyncAzureOpenAI(
-        api_key=settings.api_key,
-        api_version=settings.api_version,
-        azure_endpoint=settings.endpoint,
-    )
-except Exception as e:
-    logger.error(f"Error initializing Azure client: {e}")
+settings = get_app_settings()
 
-try:
-    deepseek_client = AsyncOpenAI(
-        api_key=settings.deepseek_api_key,
-        base_url=settings.deepseek_url,
-    )
-except Exception as e:
-    logger.error(f"Error initializing DeepSeek client: {e}")
 
-try:
-    redis = aioredis.from_url(
-        url=f"redis://{settings.redis_host}:{settings.redis_port}/0",
-        decode_responses=True,
-    )
-except Exception as e:
-    logger.error(f"Error connecting to Redis: {e}")
-
-try:
-    search_client = SearchClient(
-        endpoint=settings.search_endpoint,
-        index_name=settings.search_index,
-        credential=AzureKeyCredential(settings.search_admin_key),
+def create_llm_http_client() -> httpx.AsyncClient:
+    """
+    HTTP/2 client with a larger keep-alive pool, so concurrent chats share
+    multiplexed connections instead of opening new TLS sessions
+    """
+    return DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(
+            max_connections=settings.llm_max_connections,
+            max_keepalive_connections=settings.llm_max_keepalive_connections,
+        ),
     )
-except Exception as e:
-    logger.error(f"Error connecting to Azure Cognitive Search: {e}")
-
-
-try:
-    engine = create_engine(
-        settings.pg_url,
-        echo=True,
-        pool_pre_ping=True,
-        pool_recycle=300,
-        pool_timeout=10,
-        max_overflow=10,
-        pool_size=20,
-    )
-except Exception as e:
-    logger.error(f"Error connecting to PostgreSQL: {e}")
+
+
+@lru_cache(maxsize=1)
+def get_azure_client() -> AsyncAzureOpenAI:
+    try:
+        return AsyncAzureOpenAI(
+            api_key=settings.api_key,
+            api_version=settings.api_version,
+            azure_endpoint=settings.endpoint,
+            http_client=create_llm_http_client(),
+            max_retries=settings.llm_max_retries,
+        )
+    except Exception as e:
+        logger.error(f"Error initializing Azure client: {e}")
+        raise
+
+
+@lru_cache(maxsize=1)
+def get_embedding_client() -> AzureOpenAI:
+    """
+    Embeddings client shared by the API threads and Celery tasks, so its
+    connection pool is reused between requests
+    """
+    try:
+        return AzureOpenAI(
+            api_key=settings.api_key,
+            api_version=settings.embedding_model_api_version,
+            azure_endpoint=settings.embedding_model_url,
+            max_retries=settings.llm_max_retries,
+        )
+    except Exception as e:
+        logger.error(f"Error initializing Azure embedding client: {e}")
+        raise
+
+
+@lru_cache(maxsize=1)
+def get_deepseek_client() -> AsyncOpenAI:
+    try:
+        return AsyncOpenAI(
+            api_key=settings.deepseek_api_key,
+            base_url=settings.deepseek_url,
+            http_client=create_llm_http_client(),
+            max_retries=settings.llm_max_retries,
+        )
+    except Exception as e:
+        logger.error(f"Error initializing DeepSeek client: {e}")
+        raise
+
+
+@lru_cache(maxsize=1)
+def get_redis() -> aioredis.Redis:
+    try:
+        # A blocking pool makes callers wait for a free connection instead of
+        # failing with "Too many connections" once the pool is exhausted
+        pool = aioredis.BlockingConnectionPool.from_url(
+            url=f"redis://{settings.redis_host}:{settings.redis_port}/0",
+            decode_responses=True,
+            max_connections=settings.redis_pool_size,
+            health_check_interval=30,
+        )
+        return aioredis.Redis(connection_pool=pool)
+    except Exception as e:
+        logger.error(f"Error connecting to Redis: {e}")
+        raise
+
+
+@lru_cache(maxsize=1)
+def get_search_credential() -> AzureKeyCredential:
+    return AzureKeyCredential(settings.search_admin_key)
+
+
+@lru_cache(maxsize=1)
+def get_sync_redis() -> Redis:
+    """Redis client for Celery tasks, which run outside of an event loop"""
+    try:
+        return Redis(
+            host=settings.redis_host,
+            port=int(settings.redis_port),
+            decode_responses=True,
+            health_check_interval=30,
+        )
+    except Exception as e:
+        logger.error(f"Error connecting to Redis: {e}")
+        raise
+
+
+def create_search_client(index_name: str = settings.search_index) -> SearchClient:
+    """
+    Create a new async search client.
+
+    The client is bound to the event loop it is first used in, so the API
+    keeps one for the app lifetime and code that runs its own loop
+    (e.g. Celery tasks) creates and closes a client per run.
+    """
+    try:
+        return SearchClient(
+            endpoint=settings.search_endpoint,
+            index_name=index_name,
+            credential=get_search_credential(),
+        )
+    except Exception as e:
+        logger.error(f"Error connecting to Azure Cognitive Search: {e}")
+        raise
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    """
+    Use WAL so readers don't block the writer and skip the fsync per commit
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.close()
+
+
+@lru_cache(maxsize=1)
+def get_engine() -> Engine:
+    try:
+        if settings.sqlite_url:
+            engine = create_engine(
+                settings.sqlite_url,
+                echo=settings.debug,
+                connect_args={"check_same_thread": False},
+            )
+            event.listen(engine, "connect", set_sqlite_pragmas)
+            return engine
+
+        return create_engine(
+            settings.pg_url,
+            echo=settings.debug,
+            future=True,
+            pool_pre_ping=True,
+            pool_use_lifo=True,
+            pool_recycle=settings.pg_pool_recycle,
+            pool_timeout=settings.pg_pool_timeout,
+            max_overflow=settings.pg_max_overflow,
+            pool_size=settings.pg_pool_size,
+        )
+    except Exception as e:
+        logger.error(f"Error connecting to the database: {e}")
+        raise
+
+
+SessionLocal = sessionmaker(class_=Session, expire_on_commit=False)
+
+
+def create_session() -> Session:
+    """Create a database session bound to the shared engine"""
+    return SessionLocal(bind=get_engine())
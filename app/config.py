@@ -32,11 +32,17 @@ class App_settings(BaseSettings):
     api_key: str = os.getenv("AZURE_OPENAI_API_KEY", "")
     api_version: str = os.getenv("AZURE_OPENAI_API_VERSION", "2025-01-01-preview")
     model_name: str = os.getenv("AZURE_MODEL_NAME", "o3-mini")
+    summary_model_name: str = os.getenv("AZURE_SUMMARY_MODEL_NAME", model_name)
     deployment_name: str = os.getenv("AZURE_DEPLOYMENT_NAME", "o3-mini")
 
     deepseek_url: str = os.getenv("DEEPSEEK_API_URL", "")
     deepseek_api_key: str = os.getenv("DEEPSEEK_API_KEY", "")
     deepseek_model: str = os.getenv("DEEPSEEK_API_MODEL", "")
+    # The OpenAI SDK retries 429 and 5xx responses with exponential backoff,
+    # honoring Retry-After
+    llm_max_retries: int = int(os.getenv("AZURE_RETRY_ATTEMPTS", "5"))
+    llm_max_connections: int = 100
+    llm_max_keepalive_connections: int = 50
 
     embedding_model_name: str = os.getenv(
         "AZURE_EMBEDDING_MODEL_NAME", "text-embedding-3-large"
@@ -47,6 +53,14 @@ class App_settings(BaseSettings):
     embedding_model_size: str = os.getenv(
         "AZURE_EMBEDDING_MODEL_SIZE", "3072"
     )  # The size of embedding model 'text-embedding-3-large' that is by default
+    embedding_batch_size: int = int(
+        os.getenv("EMBEDDING_BATCH_SIZE", "128")
+    )  # Chunks per embeddings request, the API accepts up to 2048
+    embedding_cache_ttl: int = 86400  # Seconds to keep chat question embeddings in Redis
+
+    semantic_cache_threshold: float = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.86"))
+    semantic_cache_size: int = 100  # Cached answers per company
+    semantic_cache_ttl: int = 86400
 
     search_endpoint: str = os.getenv("VECTOR_STORE_URL", "")
     search_password: str = os.getenv("VECTOR_STORE_PASSWORD", "")
@@ -57,15 +71,40 @@ class App_settings(BaseSettings):
     redis_host: str = os.getenv("REDIS_HOST", "localhost")
     redis_port: str = os.getenv("REDIS_PORT", "6379")
     redis_password: str = os.getenv("REDIS_PASSWORD", "")
+    redis_pool_size: int = int(os.getenv("REDIS_POOL_SIZE", "10"))
+
+    celery_pool: str = os.getenv("CELERY_POOL", "threads")
+    celery_concurrency: int = int(os.getenv("CELERY_CONCURRENCY", "16"))
+    # Set to e.g. "uploads" to run uploads on their own workers, the default
+    # queue is the one workers started without -Q consume
+    celery_upload_queue: str = os.getenv("CELERY_UPLOAD_QUEUE", "celery")
 
     sqlite_url: str = os.getenv("SQLITE_URL", "")
     pg_url: str = Database_settings().pg_url
+    pg_pool_size: int = int(os.getenv("SQL_DB_POOL_SIZE", "10"))
+    pg_max_overflow: int = int(os.getenv("SQL_DB_MAX_OVERFLOW", "20"))
+    pg_pool_recycle: int = int(os.getenv("SQL_DB_POOL_RECYCLE", "3600"))
+    pg_pool_timeout: int = int(os.getenv("SQL_DB_POOL_TIMEOUT", "10"))
+
+    debug: bool = os.getenv("DEBUG", "false").lower() == "true"
     
     nearest_neighbors: int = 5
+    search_batch_size: int = 1000  # Max documents per Azure AI Search indexing request
+    search_batch_bytes: int = 1024 * 1024 * 14  # Request payload limit is 16 MB
+    search_scan_limit: int = 100000  # Max results when listing chunks, paged by 1000
+    upload_concurrency: int = int(os.getenv("UPLOAD_CONCURRENCY", "4"))  # Files processed at once
+    # Uploads this small are processed in the request instead of a Celery task
+    # and answered with 200 and the upload result, off by default
+    inline_upload_threshold: int = int(os.getenv("INLINE_UPLOAD_THRESHOLD", "0"))  # Files
+    inline_upload_max_size: int = 1024 * 1024  # 1 MB in total
     
     jwt_secret_key: str = os.getenv("JWT_SECRET_KEY", "")
     jwt_algorithm: str = os.getenv("JWT_ALGORITHM", "")
     session_ttl: int = 86400
+    history_keep_messages: int = 8  # Older messages are folded into a summary
+    company_cache_ttl: int = 300
+    health_cache_ttl: float = 5.0
+    prompt_cache_ttl: int = 60
     
     supported_extensions: set[str] = {".pdf", ".docx"}
     max_file_size: int = 1024 * 1024 * 100 # 100 MB
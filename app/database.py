@@ -1,116 +1,296 @@
+import asyncio
+import secrets
+from collections import defaultdict
+from typing import Iterator
 from uuid import uuid4
 from shortuuid import uuid
+from sqlalchemy import bindparam
 from sqlmodel import Session, select, delete
-from datetime import datetime, timedelta
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+import time
 import jwt
 
-from app import logger, settings
+from app import logger
+from app.config import get_app_settings
 from app.models import Company, FileMetadata, AdminPrompt
 from app.utils import create_batch, encode_document_key
-from app.clients import engine, search_client
+from azure.search.documents.aio import SearchClient
 
+settings = get_app_settings()
 
-def upload_documents(
-    documents: list[dict], company_id: str
-) -> dict[str, bool]:
-    try:
-        for file_data in documents:
-            doc_id = uuid()
-            batch = create_batch(
+_JWT = jwt.PyJWT()
+_JWT_KEY = settings.jwt_secret_key
+_JWT_ALG = settings.jwt_algorithm
+_JWT_ALGS = [_JWT_ALG]
+_SESSION_TTL = settings.session_ttl
+
+_PROMPT_BY_COMPANY = (
+    select(AdminPrompt)
+    .where(AdminPrompt.company_id == bindparam("company_id"))
+    .limit(1)
+)
+
+
+def estimate_document_size(doc: dict) -> int:
+    """
+    Roughly estimate the JSON size of a chunk, embeddings take ~20 bytes per value
+    """
+    return len(doc["content"].encode()) + 20 * len(doc["embedding"]) + 256
+
+
+def split_upload_batch(batch: list[dict]) -> Iterator[list[dict]]:
+    """
+    Split chunks into indexing requests within the Azure AI Search limits
+    on document count and payload size.
+    """
+    request_batch = []
+    request_bytes = 0
+    for doc in batch:
+        doc_bytes = estimate_document_size(doc)
+        if request_batch and (
+            len(request_batch) >= settings.search_batch_size
+            or request_bytes + doc_bytes > settings.search_batch_bytes
+        ):
+            yield request_batch
+            request_batch = []
+            request_bytes = 0
+        request_batch.append(doc)
+        request_bytes += doc_bytes
+
+    if request_batch:
+        yield request_batch
+
+
+async def upload_documents(
+    documents: list[dict],
+    company_id: str,
+    session: Session,
+    search_client: SearchClient,
+) -> dict:
+    # Text extraction and embeddings are blocking, so files are processed in
+    # worker threads, limited to avoid Azure OpenAI throttling
+    semaphore = asyncio.Semaphore(settings.upload_concurrency)
+    failed_document_ids = set()
+    uploaded_chunks = defaultdict(list)
+    pending = []
+
+    async def upload_request_batch(request_batch: list[dict]) -> None:
+        document_ids = {doc["id"]: doc["document_id"] for doc in request_batch}
+        results = await search_client.upload_documents(documents=request_batch)
+        for result in results:
+            if result.succeeded:
+                uploaded_chunks[document_ids[result.key]].append(result.key)
+            else:
+                failed_document_ids.add(document_ids[result.key])
+
+    async def flush(docs: list[dict]) -> None:
+        # Batches split by the payload limit are sent at the same time
+        await asyncio.gather(
+            *(upload_request_batch(batch) for batch in split_upload_batch(docs))
+        )
+
+    async def index_file(file_data: dict, doc_id: str) -> None:
+        async with semaphore:
+            chunk_batches = create_batch(
                 company_id=company_id,
                 file_content=file_data["file"],
                 file_name=file_data["file_name"],
                 document_id=doc_id,
             )
+            # Upload chunks as they are embedded instead of holding the whole
+            # file in memory, small files are still sent together
+            while chunk_batch := await asyncio.to_thread(next, chunk_batches, None):
+                for doc in chunk_batch:
+                    doc["id"] = encode_document_key(doc["id"])
+                pending.extend(chunk_batch)
+
+                if len(pending) >= settings.embedding_batch_size:
+                    docs = pending.copy()
+                    pending.clear()
+                    await flush(docs)
+
+    try:
+        files_metadata = [
+            FileMetadata(
+                file_name=file_data["file_name"],
+                company_id=company_id,
+                document_id=uuid(),
+            )
+            for file_data in documents
+        ]
+        # A file that can't be processed fails alone, the other files are
+        # still saved
+        results = await asyncio.gather(
+            *(
+                index_file(file_data, file.document_id)
+                for file_data, file in zip(documents, files_metadata)
+            ),
+            return_exceptions=True,
+        )
+        for file, result in zip(files_metadata, results):
+            if isinstance(result, Exception):
+                logger.error(f"Error while processing file '{file.file_name}': {result}")
+                failed_document_ids.add(file.document_id)
+        await flush(
+            [doc for doc in pending if doc["document_id"] not in failed_document_ids]
+        )
 
-            for doc in batch:
-                doc["document_id"] = doc_id
-                doc["id"] = encode_document_key(doc["id"])
-
-            results = search_client.upload_documents(documents=batch)
-
-            if results and results[0] and results[0].succeeded:
-                with Session(engine) as session:
-                    session.add(
-                        FileMetadata(
-                            file_name=file_data["file_name"],
-                            company_id=company_id,
-                            document_id=doc_id,
-                        )
-                    )
-                    session.commit()
+        # A file without uploaded chunks is not searchable, e.g. when all of
+        # its embedding batches failed
+        indexed_files = []
+        for file in files_metadata:
+            if (
+                file.document_id in failed_document_ids
+                or not uploaded_chunks[file.document_id]
+            ):
+                logger.error(f"Error while indexing file '{file.file_name}'")
             else:
-                raise
+                indexed_files.append(file)
+
+        indexed_ids = {file.document_id for file in indexed_files}
+        # Chunks are uploaded while a file is still embedded, so a file that
+        # failed part-way is removed from the index to stay unsearchable
+        orphan_chunk_ids = [
+            chunk_id
+            for file in files_metadata
+            if file.document_id not in indexed_ids
+            for chunk_id in uploaded_chunks[file.document_id]
+        ]
+        if orphan_chunk_ids and not await delete_chunks(orphan_chunk_ids, search_client):
+            logger.error(
+                f"Failed to remove chunks of unindexed files for company {company_id}"
+            )
 
-        return {"indexed": True}
+        files = [
+            {
+                "file_name": file.file_name,
+                "document_id": file.document_id,
+                "indexed": file.document_id in indexed_ids,
+            }
+            for file in files_metadata
+        ]
+        if indexed_files:
+            session.add_all(indexed_files)
+            session.commit()
+
+        return {"indexed": len(indexed_files) == len(files_metadata), "files": files}
     except Exception as e:
-        logger.error(f"Error while work with file '{file_data['file_name']}': {e}")
-        return {"indexed": False}
+        logger.error(f"Error while uploading documents for company {company_id}: {e}")
+        return {"indexed": False, "files": []}
 
 
-def get_documents(company_id: str) -> list[FileMetadata] | None:
+def get_documents(company_id: str, session: Session) -> list[FileMetadata] | None:
     try:
-        with Session(engine) as session:
-            result = session.exec(
-                select(FileMetadata).where(FileMetadata.company_id == company_id)
-            ).all()
-            logger.info(f"Found {len(result)} documents for company {company_id}")
+        result = session.exec(
+            select(FileMetadata).where(FileMetadata.company_id == company_id)
+        ).all()
+        logger.info(f"Found {len(result)} documents for company {company_id}")
 
-            return result
+        return result
     except Exception as e:
         logger.error(f"Error while getting files: {e}")
         return None
 
 
-def delete_documents(company_id: str) -> dict[str, bool]:
+async def get_chunk_ids(filter_query: str, search_client: SearchClient) -> list[str]:
+    """
+    Get IDs of all chunks in the search index that match the filter.
+
+    Only the key field is selected, so embeddings are not transferred.
+    """
+    chunks = await search_client.search(
+        search_text="*",
+        filter=filter_query,
+        select=["id"],
+        top=settings.search_scan_limit,
+        query_type="simple",
+        include_total_count=False,
+    )
+    chunk_ids = [chunk["id"] async for chunk in chunks]
+
+    if len(chunk_ids) >= settings.search_scan_limit:
+        logger.warning(
+            f"Chunk listing for '{filter_query}' reached the limit of "
+            f"{settings.search_scan_limit} results, some chunks may remain"
+        )
+    return chunk_ids
+
+
+async def delete_chunks(chunk_ids: list[str], search_client: SearchClient) -> bool:
+    """
+    Delete chunks from the search index in batches.
+
+    Stops at the first batch that fails, the caller treats the whole
+    deletion as failed anyway.
+
+    Returns:
+        bool: True if all chunks were deleted
+    """
+    for i in range(0, len(chunk_ids), settings.search_batch_size):
+        results = await search_client.delete_documents(
+            documents=[
+                {"id": chunk_id}
+                for chunk_id in chunk_ids[i : i + settings.search_batch_size]
+            ]
+        )
+        if not all(result.succeeded for result in results):
+            return False
+    return True
+
+
+async def delete_documents(
+    company_id: str, session: Session, search_client: SearchClient
+) -> dict[str, bool]:
     try:
-        filter_query = f"company_id eq '{company_id}'"
-        chunks = search_client.search(filter=filter_query, search_text="*")
-        docs = [{"id": chunk["id"]} for chunk in chunks]
-        results = search_client.delete_documents(documents=docs)
-
-        with Session(engine) as session:
-            if results and results[0] and results[0].succeeded:
-                session.exec(
-                    delete(FileMetadata).where(FileMetadata.company_id == company_id)
-                )
-                session.commit()
+        chunk_ids = await get_chunk_ids(f"company_id eq '{company_id}'", search_client)
+
+        if not await delete_chunks(chunk_ids, search_client):
+            raise RuntimeError("Failed to delete chunks from the search index")
+
+        session.exec(
+            delete(FileMetadata)
+            .where(FileMetadata.company_id == company_id)
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
 
         return {"success": True}
     except Exception as e:
+        session.rollback()
         logger.error(f"Error while deleting files: {e}")
         return {"success": False}
 
 
-def delete_document_by_id(document_id: str) -> dict[str, bool]:
+async def delete_document_by_id(
+    document_id: str, session: Session, search_client: SearchClient
+) -> dict[str, bool]:
     try:
-        filter_query = f"document_id eq '{document_id}'"
-        chunks = search_client.search(filter=filter_query, search_text="*")
-        docs = [{"id": chunk["id"]} for chunk in chunks]
+        chunk_ids = await get_chunk_ids(f"document_id eq '{document_id}'", search_client)
 
-        if not docs:
+        if not chunk_ids:
             return {"deleted": False, "error": "No document found"}
 
-        results = search_client.delete_documents(documents=docs)
+        if not await delete_chunks(chunk_ids, search_client):
+            raise RuntimeError("Failed to delete chunks from the search index")
 
-        with Session(engine) as session:
-            if results and results[0] and results[0].succeeded:
-                session.exec(
-                    delete(FileMetadata).where(FileMetadata.document_id == document_id)
-                )
-                session.commit()
-            else:
-                raise
+        session.exec(
+            delete(FileMetadata)
+            .where(FileMetadata.document_id == document_id)
+            .execution_options(synchronize_session=False)
+        )
+        session.commit()
 
         return {"success": True}
     except Exception as e:
+        session.rollback()
         logger.error(f"Error while deleting file '{document_id}': {e}")
         return {"success": False}
 
 
 def create_company(company_name: str, session: Session) -> Company | None:
     try:
-        company = Company(name=company_name, api_key=str(uuid4()))
+        company = Company(name=company_name, api_key=secrets.token_urlsafe(32))
         session.add(company)
         session.commit()
         return company
@@ -134,14 +314,20 @@ def save_admin_prompt(
         bool: True if operation succeeded
     """
     try:
-        old_prompt = session.exec(
-            select(AdminPrompt).where(AdminPrompt.company_id == company.id)
-        ).first()
-        if old_prompt:
-            session.delete(old_prompt)
-
-        new_prompt = AdminPrompt(prompt=admin_prompt.prompt, company_id=company.id)
-        session.add(new_prompt)
+        insert = (
+            sqlite_insert
+            if session.get_bind().dialect.name == "sqlite"
+            else postgresql_insert
+        )
+        statement = insert(AdminPrompt).values(
+            id=str(uuid4()), prompt=admin_prompt.prompt, company_id=company.id
+        )
+        session.exec(
+            statement.on_conflict_do_update(
+                index_elements=[AdminPrompt.company_id],
+                set_={"prompt": statement.excluded.prompt},
+            )
+        )
         session.commit()
 
         return True
@@ -160,8 +346,8 @@ def get_admin_prompt(company: Company, session: Session) -> AdminPrompt:
     admin_prompt = ""
 
     prompt_record = session.exec(
-        select(AdminPrompt).where(AdminPrompt.company_id == company.id)
-    ).first()
+        _PROMPT_BY_COMPANY, params={"company_id": company.id}
+    ).one_or_none()
     if prompt_record:
         admin_prompt = prompt_record.prompt
 
@@ -170,23 +356,20 @@ def get_admin_prompt(company: Company, session: Session) -> AdminPrompt:
 
 def create_jwt(company_id: str, session_id: str = None) -> tuple[str, str]:
     session_id = session_id or str(uuid4())
-    expires_at = datetime.today() + timedelta(seconds=settings.session_ttl)
     payload = {
         "company_id": company_id,
         "session_id": session_id,
-        "exp": expires_at,
+        "exp": int(time.time()) + _SESSION_TTL,
     }
     return (
-        jwt.encode(payload, settings.jwt_secret_key, algorithm=settings.jwt_algorithm),
+        _JWT.encode(payload, _JWT_KEY, algorithm=_JWT_ALG),
         session_id,
     )
 
 
 def decode_jwt(token: str) -> dict:
     try:
-        return jwt.decode(
-            token, settings.jwt_secret_key, algorithms=[settings.jwt_algorithm]
-        )
+        return _JWT.decode(token, _JWT_KEY, algorithms=_JWT_ALGS)
     except jwt.ExpiredSignatureError:
         raise ValueError("Token expired")
     except jwt.InvalidTokenError:
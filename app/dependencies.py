@@ -1,52 +1,93 @@
 from fastapi import Header, HTTPException, Depends, Request
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import bindparam
 from sqlmodel import Session, select
 from redis import asyncio as aioredis
 
-from app import logger, settings
+from app import logger
+from app.config import get_app_settings
 from app.models import Company
 from app.database import decode_jwt, create_jwt
-from app.clients import redis, search_client, engine
+from app.utils import get_company_cache_key
+from app.clients import get_redis, create_session
+
+settings = get_app_settings()
+
+# Built once so every request reuses the same statement and its compiled form
+_COMPANY_BY_API_KEY = select(Company).where(Company.api_key == bindparam("api_key"))
 
 
 def get_company_session():
-    with Session(engine) as session:
+    with create_session() as session:
         yield session
 
 
 def get_redis_connection():
     try:
-        return redis
+        return get_redis()
     except Exception as e:
         logger.error(f"Error connecting to Redis: {e}")
         raise HTTPException(status_code=500, detail="Redis connection error")
 
 
-def get_search_client():
+def get_search_client(request: Request):
     """
-    Get a search client.
+    Get the search client created on application startup.
 
     Returns:
         SearchClient: The search client object.
 
     Raises:
-        Exception: If the search client cannot be created.
+        Exception: If the search client is not available.
     """
     try:
-        return search_client
+        return request.app.state.search_client
     except Exception as e:
         logger.error(f"Error connecting to Azure AI Search: {e}")
         raise HTTPException(status_code=500, detail="Azure AI Search connection error")
 
 
-def get_current_company(
-    x_api_key: str = Header(...), session: Session = Depends(get_company_session)
+async def get_current_company(
+    x_api_key: str = Header(...),
+    session: Session = Depends(get_company_session),
+    redis: aioredis.Redis = Depends(get_redis_connection),
 ) -> Company:
-    company = session.exec(select(Company).where(Company.api_key == x_api_key)).first()
+    cache_key = get_company_cache_key(x_api_key)
+    try:
+        cached_company = await redis.get(cache_key)
+        if cached_company:
+            # The key is not cached, the request header is the one that matched
+            company = Company.model_validate_json(cached_company)
+            company.api_key = x_api_key
+            return company
+    except aioredis.RedisError as e:
+        logger.warning(f"Company cache is unavailable: {e}")
+
+    company = await run_in_threadpool(
+        lambda: session.exec(
+            _COMPANY_BY_API_KEY, params={"api_key": x_api_key}
+        ).first()
+    )
     if not company:
         raise HTTPException(status_code=401, detail="Invalid API Key")
+
+    try:
+        await redis.setex(
+            cache_key,
+            settings.company_cache_ttl,
+            company.model_dump_json(exclude={"api_key"}),
+        )
+    except aioredis.RedisError as e:
+        logger.warning(f"Failed to cache company {company.id}: {e}")
     return company
 
 
+async def start_new_session(company: Company, redis: aioredis.Redis) -> tuple[str, str]:
+    new_token, new_session_id = create_jwt(company.id)
+    await redis.setex(f"session:{new_session_id}", settings.session_ttl, company.id)
+    return new_session_id, new_token
+
+
 async def get_session_from_jwt(
     request: Request,
     company: Company = Depends(get_current_company),
@@ -54,24 +95,29 @@ async def get_session_from_jwt(
 ) -> tuple[str, str]:
     authorization = request.headers.get("Authorization")
 
-    if authorization and authorization.startswith("Bearer "):
-        token = authorization.split(" ")[1]
-        try:
-            payload = decode_jwt(token)
-            session_id = payload["session_id"]
-
-            session_data = await redis.get(f"session:{session_id}")
-            if not session_data:
-                new_token, new_session_id = create_jwt(company.id)
-                await redis.setex(f"session:{new_session_id}", settings.session_ttl, company.id)
-                return new_session_id, new_token
-
-            return session_id, token
-        except ValueError:
-            new_token, new_session_id = create_jwt(company.id)
-            await redis.setex(f"session:{new_session_id}", settings.session_ttl, company.id)
-            return new_session_id, new_token
-    else:
-        new_token, new_session_id = create_jwt(company.id)
-        await redis.setex(f"session:{new_session_id}", settings.session_ttl, company.id)
-        return new_session_id, new_token
+    if not authorization or not authorization.startswith("Bearer "):
+        return await start_new_session(company, redis)
+
+    token = authorization.split(" ")[1]
+    try:
+        payload = decode_jwt(token)
+    except ValueError:
+        return await start_new_session(company, redis)
+
+    session_id = payload["session_id"]
+    session_key = f"session:{session_id}"
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.get(session_key)
+        pipe.ttl(session_key)
+        session_data, ttl = await pipe.execute()
+
+    if not session_data:
+        return await start_new_session(company, redis)
+
+    # Extend the session only once half of it is used up, so most requests
+    # don't write to Redis
+    if ttl < settings.session_ttl // 2:
+        token, _ = create_jwt(company.id, session_id)
+        await redis.expire(session_key, settings.session_ttl)
+
+    return session_id, token
@@ -1,10 +1,15 @@
-import json
+import asyncio
+import time
+import orjson
 from pydantic import ValidationError, HttpUrl
-from fastapi import APIRouter, Depends, HTTPException, status, File, UploadFile, Form, Path
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, HTTPException, status, File, UploadFile, Form, Path, Query
+from fastapi.responses import JSONResponse, StreamingResponse
+from starlette.background import BackgroundTask
+from redis import asyncio as aioredis
 from azure.search.documents.models import VectorizedQuery
-from azure.core.exceptions import ServiceRequestError
 from sqlmodel import Session, text, select, func
+from sqlalchemy.exc import SQLAlchemyError
+from celery import chord, states
 from celery.result import AsyncResult
 from openai import (
     APIError,
@@ -14,18 +19,35 @@ from openai import (
     ContentFilterFinishReasonError,
 )
 
-from app import logger, settings
+from app import logger
+from app.config import get_app_settings
 from app.models import Company
-from app.utils import get_embedding, get_redis_history, set_redis_history
+from app.utils import (
+    get_cached_embedding,
+    get_semantic_cache_answer,
+    get_exact_cache_answer,
+    add_semantic_cache_answer,
+    clear_semantic_cache,
+    get_redis_history,
+    set_redis_history,
+    get_company_cache_key,
+    get_prompt_cache_key,
+)
 from app.celery_worker import celery_tasks
-from app.tasks import upload_documents_task, delete_documents_task, delete_company_task
-from app.clients import azure_client, deepseek_client, search_client, redis, engine
+from app.tasks import (
+    upload_documents_task,
+    merge_upload_results,
+    delete_documents_task,
+    delete_company_task,
+)
+from app.clients import get_azure_client, get_deepseek_client, get_redis, create_session
 from app.schemas import (
     RegisterResponse,
     RegisterRequest,
     ChatRequest,
     TaskResponse,
     TaskStatusResponse,
+    UploadResultResponse,
     AdminPromptRequest,
     WebhookRequest,
     HealthResponse,
@@ -47,9 +69,288 @@ from app.dependencies import (
     get_search_client,
 )
 
+settings = get_app_settings()
 
 router = APIRouter()
 
+SYSTEM_PROMPT = "Используй только предоставленный контекст для ответа."
+SUMMARY_PROMPT = (
+    "Обнови краткое содержание разговора с учетом новых сообщений. "
+    "Ответь одним-двумя предложениями."
+)
+
+
+async def search_context(
+    search_client, company_id: str, q_emb: list[float] | None
+) -> str:
+    """
+    Find the company's chunks closest to the question and join them
+    """
+    if q_emb is None:
+        return ""
+
+    try:
+        vectorized_query = VectorizedQuery(
+            vector=q_emb,
+            k_nearest_neighbors=settings.nearest_neighbors,
+            fields="embedding",
+        )
+
+        logger.info(f"Searching for documents for company {company_id}")
+        # Pure vector query, only the chunk text is read from the hits
+        results = await search_client.search(
+            search_text=None,
+            vector_queries=[vectorized_query],
+            filter=f"company_id eq '{company_id}'",
+            select=["content"],
+            top=settings.nearest_neighbors,
+        )
+        logger.info(f"Found documents for company {company_id}")
+        return "\n".join([doc["content"] async for doc in results])
+    except Exception as e:
+        logger.error(f"Error searching for documents: {e}")
+        return ""
+
+
+async def get_cached_admin_prompt(redis, company: Company, session: Session) -> str:
+    """
+    Get the company's admin prompt from Redis, reading the database on a miss
+    """
+    key = get_prompt_cache_key(company.id)
+    try:
+        cached = await redis.get(key)
+        if cached is not None:
+            return cached
+    except Exception as e:
+        logger.warning(f"Admin prompt cache is unavailable: {e}")
+
+    admin_prompt = await asyncio.to_thread(get_admin_prompt, company, session)
+    try:
+        await redis.set(key, admin_prompt, ex=settings.prompt_cache_ttl)
+    except Exception as e:
+        logger.warning(f"Failed to cache admin prompt: {e}")
+    return admin_prompt
+
+
+async def create_chat_completion(messages: list[dict], stream: bool = False):
+    """
+    Get an answer from Azure OpenAI, falling back to DeepSeek if it fails.
+    With `stream` the opened stream of answer chunks is returned instead.
+    """
+    try:
+        client = get_azure_client()
+
+        response = await client.chat.completions.create(
+            model=settings.model_name,
+            messages=messages,
+            stream=stream,
+        )
+    except (
+        APIError,
+        RateLimitError,
+        InternalServerError,
+        LengthFinishReasonError,
+        ContentFilterFinishReasonError,
+    ) as e:
+        logger.warning(
+            f"Azure OpenAI is not available. Trying to use Deepseek API. {e}"
+        )
+        client = get_deepseek_client()
+        try:
+            response = await client.chat.completions.create(
+                model=settings.model_name,
+                messages=messages,
+                stream=stream,
+            )
+        except Exception as e:
+            logger.error(f"Error using Deepseek API: {e}")
+            raise HTTPException(
+                status_code=503,
+                detail="Failed to retrieve response from Azure OpenAI or Deepseek API. Try later.",
+            )
+    except Exception as e:
+        logger.error(f"Unexpected error: {e}")
+        raise HTTPException(
+            status_code=503,
+            detail="Unexpected error. Failed to retrieve response from Azure OpenAI or Deepseek API",
+        )
+
+    if stream:
+        return response
+    return response.choices[0].message.content
+
+
+def format_sse(data: str) -> str:
+    return f"data: {data}\n\n"
+
+
+async def save_chat_history(
+    redis, company_id: str, session_id: str, question: str, answer: str
+) -> None:
+    try:
+        await set_redis_history(
+            redis,
+            f"history:{company_id}:{session_id}",
+            orjson.dumps({"role": "user", "content": question}),
+            orjson.dumps({"role": "assistant", "content": answer}),
+        )
+        logger.info(f"Chat history is saved successfully for company {company_id}")
+    except Exception as e:
+        logger.error(f"Error saving chat history: {e} for company {company_id}")
+
+
+async def update_history_summary(redis, company_id: str, session_id: str) -> None:
+    """
+    Fold messages older than the last `history_keep_messages` into a short
+    summary, so the prompt stays bounded in long conversations
+    """
+    key = f"history:{company_id}:{session_id}"
+    summary_key = f"summary:{company_id}:{session_id}"
+    try:
+        history = await redis.lrange(key, 0, -1)
+        overflow = len(history) - settings.history_keep_messages
+        if overflow <= 0:
+            return
+
+        summary = await redis.get(summary_key)
+        earlier = "\n".join(
+            f"{message['role']}: {message['content']}"
+            for message in map(orjson.loads, history[:overflow])
+        )
+        response = await get_azure_client().chat.completions.create(
+            model=settings.summary_model_name,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {
+                    "role": "user",
+                    "content": f"Краткое содержание:\n{summary or ''}\n\nНовые сообщения:\n{earlier}",
+                },
+            ],
+        )
+
+        # A turn saved during the LLM call may have already dropped the oldest
+        # messages, so only those of the summarized ones still at the head of
+        # the list are trimmed
+        async with redis.pipeline(transaction=True) as pipe:
+            await pipe.watch(key)
+            current = await pipe.lrange(key, 0, len(history) - 1)
+            shift = next(
+                (
+                    i
+                    for i in range(overflow + 1)
+                    if current[: len(history) - i] == history[i:]
+                ),
+                None,
+            )
+            pipe.multi()
+            pipe.set(
+                summary_key, response.choices[0].message.content, ex=settings.session_ttl
+            )
+            if shift is not None:
+                pipe.ltrim(key, overflow - shift, -1)
+            await pipe.execute()
+        logger.info(f"Chat history is summarized for company {company_id}")
+    except aioredis.WatchError:
+        # The next turn summarizes the same messages again
+        logger.info(f"Chat history changed while summarizing for company {company_id}")
+    except Exception as e:
+        logger.error(f"Error summarizing chat history: {e} for company {company_id}")
+
+
+async def stream_chat_answer(
+    stream,
+    redis,
+    company_id: str,
+    session_id: str,
+    question: str,
+    cache_embedding: list[float] | None,
+):
+    """
+    Forward answer tokens as server-sent events and save the answer once
+    the stream ends. Only complete answers go to the semantic cache.
+    """
+    parts = []
+    completed = False
+    try:
+        async for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                token = chunk.choices[0].delta.content
+                parts.append(token)
+                yield format_sse(orjson.dumps({"content": token}).decode())
+        completed = True
+        yield format_sse("[DONE]")
+    except Exception as e:
+        logger.error(f"Error streaming answer for company {company_id}: {e}")
+    finally:
+        answer = "".join(parts)
+        if answer:
+            await save_chat_history(redis, company_id, session_id, question, answer)
+        if completed and cache_embedding is not None:
+            await add_semantic_cache_answer(
+                redis, company_id, question, cache_embedding, answer
+            )
+
+
+async def check_postgres() -> str:
+    def select_one():
+        with create_session() as session:
+            return session.exec(text("SELECT 1")).one()
+
+    result = await asyncio.to_thread(select_one)
+    if result[0] != 1:
+        raise ConnectionError("PostgreSQL test query failed")
+    return "OK"
+
+
+async def check_redis() -> str:
+    if not await get_redis().ping():
+        raise ConnectionError("Redis ping failed")
+    return "OK"
+
+
+async def check_azure_search(search_client) -> dict:
+    document_count = await search_client.get_document_count()
+    return {"status": "OK", "documents_count": document_count}
+
+
+async def get_health_status(search_client) -> dict:
+    health_status = {
+        "status": True,
+        "message": "All systems operational",
+        "services": {},
+    }
+    errors = []
+
+    # The probes are independent, so the check takes as long as the slowest
+    postgres, redis, azure_search = await asyncio.gather(
+        check_postgres(),
+        check_redis(),
+        check_azure_search(search_client),
+        return_exceptions=True,
+    )
+
+    for service, name, result in (
+        ("postgres", "PostgreSQL", postgres),
+        ("redis", "Redis", redis),
+        ("azure_search", "Azure Search", azure_search),
+    ):
+        if isinstance(result, Exception):
+            error_msg = f"{name}: {str(result)}"
+            result = {"status": error_msg} if service == "azure_search" else error_msg
+            errors.append(error_msg)
+            logger.error(error_msg)
+        health_status["services"][service] = result
+
+    if errors:
+        health_status["status"] = False
+        health_status["message"] = f"Service degradation: {len(errors)} critical issues"
+
+    return health_status
+
+
+_health_lock = asyncio.Lock()
+_health_cache = {"checked_at": float("-inf"), "status": None}
+
 
 @router.get(
     "/",
@@ -98,7 +399,7 @@ router = APIRouter()
     },
     response_model=HealthResponse,
 )
-async def root():
+async def root(search_client=Depends(get_search_client)):
     """
     Comprehensive health check of critical system dependencies.
 
@@ -110,57 +411,15 @@ async def root():
     For Azure AI Search, checks index statistics including:
     - Documents count
     """
-    health_status = {
-        "status": True,
-        "message": "All systems operational",
-        "services": {},
-    }
-    errors = []
-
-    try:
-        with Session(engine) as session:
-            result = session.exec(text("SELECT 1")).one()
-            if result[0] != 1:
-                raise ConnectionError("PostgreSQL test query failed")
-            health_status["services"]["postgres"] = "OK"
-    except Exception as e:
-        error_msg = f"PostgreSQL: {str(e)}"
-        health_status["services"]["postgres"] = error_msg
-        errors.append(error_msg)
-        logger.error(error_msg)
-
-    try:
-        if await redis.ping():
-            health_status["services"]["redis"] = "OK"
-        else:
-            raise ConnectionError("Redis ping failed")
-    except Exception as e:
-        error_msg = f"Redis: {str(e)}"
-        health_status["services"]["redis"] = error_msg
-        errors.append(error_msg)
-        logger.error(error_msg)
-
-    try:
-        document_count = search_client.get_document_count()
-
-        health_status["services"]["azure_search"] = {
-            "status": "OK",
-            "documents_count": document_count,
-        }
-    except ServiceRequestError as e:
-        error_msg = f"Azure Search: {str(e)}"
-        health_status["services"]["azure_search"] = {"status": error_msg}
-        errors.append(error_msg)
-        logger.error(error_msg)
-    except Exception as e:
-        error_msg = f"Azure Search: {str(e)}"
-        health_status["services"]["azure_search"] = {"status": error_msg}
-        errors.append(error_msg)
-        logger.error(error_msg)
-
-    if errors:
-        health_status["status"] = False
-        health_status["message"] = f"Service degradation: {len(errors)} critical issues"
+    # Pollers within the TTL share one probe instead of each hitting the
+    # dependencies, the lock lets a single caller refresh it
+    async with _health_lock:
+        if time.monotonic() - _health_cache["checked_at"] >= settings.health_cache_ttl:
+            _health_cache["status"] = await get_health_status(search_client)
+            _health_cache["checked_at"] = time.monotonic()
+        health_status = _health_cache["status"]
+
+    if not health_status["status"]:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=health_status
         )
@@ -230,7 +489,9 @@ async def register_company(
     """
     try:
         existing_company = session.exec(
-            select(Company).where(func.lower(Company.name) == func.lower(req.name))
+            select(Company.id)
+            .where(func.lower(Company.name) == func.lower(req.name))
+            .limit(1)
         ).first()
 
         if existing_company:
@@ -303,6 +564,7 @@ async def register_company(
 async def delete_company(
     body: WebhookRequest,
     company: Company = Depends(get_current_company),
+    redis=Depends(get_redis_connection),
 ):
     """
     Initiate company deletion process as an asynchronous task.
@@ -332,6 +594,7 @@ async def delete_company(
         task = delete_company_task.delay(
             company_id=company.id, url=str(body.webhook_url)
         )
+        await redis.delete(get_company_cache_key(company.api_key))
 
         return TaskResponse(
             task_id=task.id,
@@ -356,6 +619,30 @@ async def delete_company(
     summary="Upload documents for a company",
     response_description="Task ID for the upload operation",
     responses={
+        status.HTTP_200_OK: {
+            "description": "Small upload processed in the request, "
+            "when INLINE_UPLOAD_THRESHOLD is set",
+            "model": UploadResultResponse,
+            "content": {
+                "application/json": {
+                    "example": {
+                        "success": True,
+                        "company_id": "550e8400-e29b-41d4-a716-446655440000",
+                        "errors": [],
+                        "details": {
+                            "documents_uploaded": True,
+                            "files": [
+                                {
+                                    "file_name": "report.pdf",
+                                    "document_id": "nJ8pTkDqVb6cRmWz3yXhLs",
+                                    "indexed": True,
+                                }
+                            ],
+                        },
+                    }
+                }
+            },
+        },
         status.HTTP_202_ACCEPTED: {
             "description": "Upload task successfully queued",
             "content": {
@@ -409,11 +696,13 @@ async def upload(
     Process:
     1. Validate uploaded files and webhook URL
     2. Read file content into memory
-    3. Queue background task for document processing
+    3. Queue a background task per file for document processing
 
     Important:
     - Actual upload happens asynchronously
-    - Results will be sent to the provided webhook URL
+    - Small uploads (see INLINE_UPLOAD_THRESHOLD) are processed in the request
+      and return the upload result with status 200 instead of a task ID
+    - Results of all files will be sent to the provided webhook URL at once
     - **Only supports PDF and DOCX files**
     - Files must not exceed 100 MB
     - Azure AI Search upload is asynchronous, success response is immediate
@@ -461,15 +750,32 @@ async def upload(
         
     
     logger.info(f"Received documents to upload: {len(file_data)}. Company: name - {company.name}, id - {company.id}")
-    try:
-        task = upload_documents_task.delay(
-            documents=file_data, company_id=company.id, url=str(webhook_url)
+    # Going through the broker costs more than processing a small upload here
+    if (
+        len(file_data) <= settings.inline_upload_threshold
+        and sum(len(data["file"]) for data in file_data) <= settings.inline_upload_max_size
+    ):
+        result = await asyncio.to_thread(
+            upload_documents_task.run,
+            documents=file_data,
+            company_id=company.id,
+            url=str(webhook_url),
         )
+        return JSONResponse(status_code=status.HTTP_200_OK, content=result)
+
+    try:
+        # A task per file keeps broker messages small, spreads files over the
+        # workers and lets one failed file be retried on its own. The callback
+        # merges their results and sends the webhook once for the upload
+        job = chord(
+            upload_documents_task.s(documents=[data], company_id=company.id, url=None)
+            for data in file_data
+        )(merge_upload_results.s(company_id=company.id, url=str(webhook_url)))
 
         return TaskResponse(
-            task_id=task.id,
+            task_id=job.id,
             message=f"Document upload task started. Results will be sent to {webhook_url}",
-            monitoring_url=f"/documents/upload/status/{task.id}",
+            monitoring_url=f"/documents/upload/status/{job.id}",
         )
     except ValidationError as ve:
         logger.error(f"Validation error in request body: {ve}")
@@ -627,6 +933,9 @@ async def delete_all_documents(
 async def delete_document(
     document_id: str = Path(..., description="The ID of the document to delete"),
     company: Company = Depends(get_current_company),
+    session: Session = Depends(get_company_session),
+    redis=Depends(get_redis_connection),
+    search_client=Depends(get_search_client),
 ):
     """
     Delete a specific document for the current company.
@@ -655,7 +964,9 @@ async def delete_document(
     try:
         logger.info(f"Deleting document {document_id} for company {company.id}")
 
-        result = delete_document_by_id(document_id=document_id)
+        result = await delete_document_by_id(
+            document_id=document_id, session=session, search_client=search_client
+        )
 
         if not result or not result.get("success", False):
             raise HTTPException(
@@ -663,6 +974,7 @@ async def delete_document(
                 detail=f"Document with ID '{document_id}' not found",
             )
 
+        await clear_semantic_cache(redis, company.id)
         logger.info(f"Document deleted successfully: {document_id}")
 
         return DeleteDocumentResponse(status=result)  # {"success": True}
@@ -725,6 +1037,7 @@ async def delete_document(
 )
 async def get_documents_for_company(
     company: Company = Depends(get_current_company),
+    session: Session = Depends(get_company_session),
 ) -> DocumentListResponse:
     """
     Retrieve all documents for the current authenticated company.
@@ -745,7 +1058,7 @@ async def get_documents_for_company(
     try:
         logger.info(f"Fetching documents for company {company.id}")
 
-        result = get_documents(company_id=company.id)
+        result = get_documents(company_id=company.id, session=session)
 
         if result is None:
             logger.info(f"No documents found for company {company.id}")
@@ -762,52 +1075,98 @@ async def get_documents_for_company(
         )
 
 
+def is_task_ready(meta: str | None) -> bool:
+    return meta is not None and orjson.loads(meta)["status"] in states.READY_STATES
+
+
+async def wait_for_tasks(redis, task_ids: list[str], timeout: int) -> None:
+    """
+    Poll the Celery Redis backend until all tasks have results or the
+    timeout expires.
+
+    A connection is taken only for each poll, so waiting requests don't hold
+    the shared pool that chat and authentication use.
+    """
+    keys = [f"celery-task-meta-{task_id}" for task_id in task_ids]
+    deadline = time.monotonic() + timeout
+    delay = 0.1
+    try:
+        while not all(map(is_task_ready, await redis.mget(keys))):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(delay * 2, 2.0)
+    except Exception as e:
+        logger.error(f"Error waiting for tasks {task_ids}: {e}")
+
+
+def get_task_status(task_id: str) -> TaskStatusResponse:
+    task = AsyncResult(task_id, app=celery_tasks)
+    logger.info(f"Task status is ready: {task.ready()}")
+    return TaskStatusResponse(status=task.status, result=task.result)
+
+
+WAIT_QUERY = Query(
+    0, ge=0, le=30, description="Seconds to wait for the task to finish before answering"
+)
+
+
 @router.get("/documents/upload/status/{task_id}", tags=["Tasks status"])
-async def get_upload_status(task_id: str):
+async def get_upload_status(
+    task_id: str, wait: int = WAIT_QUERY, redis=Depends(get_redis_connection)
+):
     """
     Get the status of an upload task.
 
     Args:
         task_id (str): The ID of the task to check.
+        wait (int): Seconds to wait for the task to finish, 0 returns at once.
 
     Returns:
         TaskStatusResponse: The response object containing the status and result of the task.
     """
-    task = AsyncResult(task_id, app=celery_tasks)
-    logger.info(f"Task status is ready: {task.ready()}")
-    return TaskStatusResponse(status=task.status, result=task.result)
+    if wait:
+        await wait_for_tasks(redis, [task_id], wait)
+    return await asyncio.to_thread(get_task_status, task_id)
 
 
 @router.get("/documents/delete/status/{task_id}", tags=["Tasks status"])
-async def get_deleting_status(task_id: str):
+async def get_deleting_status(
+    task_id: str, wait: int = WAIT_QUERY, redis=Depends(get_redis_connection)
+):
     """
     Get the status of a deleting task.
 
     Args:
         task_id (str): The ID of the task to check.
+        wait (int): Seconds to wait for the task to finish, 0 returns at once.
 
     Returns:
         TaskStatusResponse: The response object containing the status and result of the task.
     """
-    task = AsyncResult(task_id, app=celery_tasks)
-    logger.info(f"Task status is ready: {task.ready()}")
-    return TaskStatusResponse(status=task.status, result=task.result)
+    if wait:
+        await wait_for_tasks(redis, [task_id], wait)
+    return await asyncio.to_thread(get_task_status, task_id)
 
 
 @router.get("/company/delete/status/{task_id}", tags=["Tasks status"])
-async def get_company_deleting_status(task_id: str):
+async def get_company_deleting_status(
+    task_id: str, wait: int = WAIT_QUERY, redis=Depends(get_redis_connection)
+):
     """
     Get the status of a company deleting task.
 
     Args:
         task_id (str): The ID of the task to check.
+        wait (int): Seconds to wait for the task to finish, 0 returns at once.
 
     Returns:
         TaskStatusResponse: The response object containing the status and result of the task.
     """
-    task = AsyncResult(task_id, app=celery_tasks)
-    logger.info(f"Task status is ready: {task.ready()}")
-    return TaskStatusResponse(status=task.status, result=task.result)
+    if wait:
+        await wait_for_tasks(redis, [task_id], wait)
+    return await asyncio.to_thread(get_task_status, task_id)
 
 
 @router.post(
@@ -823,7 +1182,10 @@ async def get_company_deleting_status(task_id: str):
                     "example": {
                         "answer": "The answer to your question is based on the provided context."
                     }
-                }
+                },
+                "text/event-stream": {
+                    "example": 'data: {"content": "The answer"}\n\ndata: [DONE]\n\n'
+                },
             },
             "headers": {
                 "x-jwt-token": {
@@ -887,6 +1249,8 @@ async def chat(
     Args:
 
         - question: User's query text
+        - stream: Stream the answer as server-sent events (`data: {"content": ...}`
+          chunks followed by `data: [DONE]`)
 
     Returns:
         - answer: Generated response to the question
@@ -902,122 +1266,106 @@ async def chat(
 
     session_id, jwt_token = session_data
 
-    try:
-        messages = await get_redis_history(redis, f"history:{company.id}:{session_id}")
-    except Exception as e:
-        logger.error(f"Error getting redis history: {e}")
+    # History and the question embedding don't depend on each other
+    messages, summary, exact_answer, q_emb = await asyncio.gather(
+        get_redis_history(redis, f"history:{company.id}:{session_id}"),
+        redis.get(f"summary:{company.id}:{session_id}"),
+        get_exact_cache_answer(redis, company.id, req.question),
+        get_cached_embedding(redis, req.question),
+        return_exceptions=True,
+    )
+    if isinstance(messages, Exception):
+        logger.error(f"Error getting redis history: {messages}")
         messages = []
-    try:
-        q_emb = get_embedding(req.question)
-
-        vectorized_query = VectorizedQuery(
-            vector=q_emb,
-            k_nearest_neighbors=settings.nearest_neighbors,
-            fields="embedding",
+    if isinstance(summary, Exception):
+        logger.error(f"Error getting history summary: {summary}")
+        summary = None
+    if isinstance(exact_answer, Exception):
+        logger.error(f"Error getting exact cache answer: {exact_answer}")
+        exact_answer = None
+    if isinstance(q_emb, Exception):
+        logger.error(f"Error creating question embedding: {q_emb}")
+        q_emb = None
+
+    # Without history the answer depends only on the question, so answers
+    # to similar first questions can be reused
+    is_new_conversation = not messages and not summary
+    answer = None
+    if is_new_conversation:
+        # The same question again doesn't need the whole semantic cache
+        answer = exact_answer
+        if answer is None and q_emb is not None:
+            answer = await get_semantic_cache_answer(redis, company.id, q_emb)
+
+    if answer is None:
+        context, admin_prompt = await asyncio.gather(
+            search_context(search_client, company.id, q_emb),
+            get_cached_admin_prompt(redis, company, session),
         )
+        logger.info("Context is completed.")
+        logger.info(f"Admin prompt: {admin_prompt}")
 
-        logger.info(f"Searching for documents for company {company.id}")
-        results = search_client.search(
-            search_text="*",
-            vector_queries=[vectorized_query],
-            filter=f"company_id eq '{company.id}'",
-        )
-        logger.info(f"Found documents for company {company.id}")
-        context = "\n".join([doc["content"] for doc in results])
-    except Exception as e:
-        logger.error(f"Error searching for documents: {e}")
-        context = ""
-
-    logger.info("Context is completed.")
-
-    admin_prompt = get_admin_prompt(company, session)
-    logger.info(f"Admin prompt: {admin_prompt}")
-
-    system_prompt = [
-        {
-            "role": "system",
-            "content": f"Используй только предоставленный контекст для ответа. {admin_prompt}",
-        }
-    ]
-    messages.append(
-        {
-            "role": "user",
-            "content": f"Контекст:\n{context}\n\nВопрос:\n{req.question}",
-        }
-    )
-    try:
-        final_messages = system_prompt + messages
-    except TypeError as e:
-        logger.error(f"Error appending messages: {e}: {messages}")
-        final_messages = system_prompt + [
+        messages.append(
             {
                 "role": "user",
                 "content": f"Контекст:\n{context}\n\nВопрос:\n{req.question}",
             }
-        ]
-    except Exception as e:
-        logger.error(f"Unexpected error appending messages: {e}")
-        final_messages = system_prompt + [
-            {
-                "role": "user",
-                "content": f"Контекст:\n{context}\n\nВопрос:\n{req.question}",
-            }
-        ]
-
-    logger.info("Final messages is completed.")
-
-    try:
-        client = azure_client
-
-        response = await client.chat.completions.create(
-            model=settings.model_name,
-            messages=final_messages,
-            stream=False,
-        )
-    except (
-        APIError,
-        RateLimitError,
-        InternalServerError,
-        LengthFinishReasonError,
-        ContentFilterFinishReasonError,
-    ) as e:
-        logger.warning(
-            f"Azure OpenAI is not available. Trying to use Deepseek API. {e}"
         )
-        client = deepseek_client
-        try:
-            response = await client.chat.completions.create(
-                model=settings.model_name,
-                messages=final_messages,
-            )
-        except Exception as e:
-            logger.error(f"Error using Deepseek API: {e}")
-            raise HTTPException(
-                status_code=503,
-                detail="Failed to retrieve response from Azure OpenAI or Deepseek API. Try later.",
+        if summary:
+            messages.insert(
+                0,
+                {"role": "system", "content": f"Краткое содержание разговора: {summary}"},
             )
-    except Exception as e:
-        logger.error(f"Unexpected error: {e}")
-        raise HTTPException(
-            status_code=503,
-            detail="Unexpected error. Failed to retrieve response from Azure OpenAI or Deepseek API",
+        messages.insert(
+            0, {"role": "system", "content": f"{SYSTEM_PROMPT} {admin_prompt}"}
         )
 
-    answer = response.choices[0].message.content
-    logger.info(f"Answer is ready for company {company.id}")
+        logger.info("Final messages is completed.")
+
+        cache_embedding = q_emb if is_new_conversation and context else None
+        # Runs after the response is sent, so the summary call adds no latency
+        summarize = BackgroundTask(update_history_summary, redis, company.id, session_id)
+        if req.stream:
+            stream = await create_chat_completion(messages, stream=True)
+            return StreamingResponse(
+                stream_chat_answer(
+                    stream, redis, company.id, session_id, req.question, cache_embedding
+                ),
+                media_type="text/event-stream",
+                headers={"x-jwt-token": jwt_token},
+                background=summarize,
+            )
 
-    try:
-        await set_redis_history(
-            redis,
-            f"history:{company.id}:{session_id}",
-            json.dumps({"role": "user", "content": req.question}),
-            json.dumps({"role": "assistant", "content": answer}),
-        )
-        logger.info(f"Chat history is saved successfully for company {company.id}")
-    except Exception as e:
-        logger.error(f"Error saving chat history: {e} for company {company.id}")
+        answer = await create_chat_completion(messages)
+        logger.info(f"Answer is ready for company {company.id}")
 
-    return JSONResponse(content={"answer": answer}, headers={"x-jwt-token": jwt_token})
+        if cache_embedding is not None:
+            await add_semantic_cache_answer(
+                redis, company.id, req.question, cache_embedding, answer
+            )
+    else:
+        # A cached answer only starts a conversation, there is nothing to summarize
+        summarize = None
+
+    await save_chat_history(redis, company.id, session_id, req.question, answer)
+
+    if req.stream:
+        return StreamingResponse(
+            iter(
+                [
+                    format_sse(orjson.dumps({"content": answer}).decode()),
+                    format_sse("[DONE]"),
+                ]
+            ),
+            media_type="text/event-stream",
+            headers={"x-jwt-token": jwt_token},
+            background=summarize,
+        )
+    return JSONResponse(
+        content={"answer": answer},
+        headers={"x-jwt-token": jwt_token},
+        background=summarize,
+    )
 
 
 @router.post(
@@ -1037,14 +1385,6 @@ async def chat(
                 }
             }
         },
-        status.HTTP_400_BAD_REQUEST: {
-            "description": "Invalid request data",
-            "content": {
-                "application/json": {
-                    "example": {"detail": "Invalid prompt format: Prompt must contain at least 5 characters"}
-                }
-            }
-        },
         status.HTTP_401_UNAUTHORIZED: {
             "description": "Invalid or missing API key",
             "content": {
@@ -1057,7 +1397,7 @@ async def chat(
             "description": "Internal server error",
             "content": {
                 "application/json": {
-                    "example": {"detail": "Failed to save prompt: Database connection timeout"}
+                    "example": {"detail": "Failed to save admin prompt"}
                 }
             }
         }
@@ -1068,6 +1408,7 @@ async def save_prompt(
     req: AdminPromptRequest,
     company: Company = Depends(get_current_company),
     session: Session = Depends(get_company_session),
+    redis=Depends(get_redis_connection),
 ):
     """
     Save or update the administrative prompt for a company.
@@ -1092,27 +1433,23 @@ async def save_prompt(
     Raises:
     
         HTTPException:
-            - 400: Invalid request data
             - 401: Authentication failed
+            - 422: Invalid request data
             - 500: Database operation error
     """
+    logger.info(f"Saving admin prompt for company {company.id}")
     try:
-        logger.info(f"Saving admin prompt for company {company.id}")
-        try:
-            return {"saved": save_admin_prompt(req, company, session)}
-        except ValidationError as ve:
-            logger.error(f"Validation error in prompt request: {ve}")
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Invalid prompt format: {ve}"
-            )
-        
-        except Exception as e:
-            logger.error(f"Critical error saving prompt for company {company.id}: {str(e)}")
-            raise HTTPException(
-                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                detail=f"Failed to save prompt: {str(e)}"
-            )
+        saved = save_admin_prompt(req, company, session)
+    except SQLAlchemyError as e:
+        logger.error(f"Database error saving prompt for company {company.id}: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Failed to save admin prompt",
+        )
+
+    try:
+        await redis.delete(get_prompt_cache_key(company.id))
     except Exception as e:
-        logger.error(f"Error saving admin prompt: {e}")
-        return {"saved": False}
+        logger.warning(f"Failed to clear admin prompt cache: {e}")
+    await clear_semantic_cache(redis, company.id)
+    return {"saved": saved}
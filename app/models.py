@@ -1,3 +1,4 @@
+import secrets
 from uuid import uuid4
 from sqlmodel import SQLModel, Field
 from typing import Optional
@@ -15,7 +16,7 @@ class Company(SQLModel, table=True):
 
     id: str = Field(default_factory=lambda: str(uuid4()), primary_key=True)
     name: str = Field(index=True)
-    api_key: str = Field(default_factory=lambda: str(uuid4()), index=True, unique=True)
+    api_key: str = Field(default_factory=lambda: secrets.token_urlsafe(32), index=True, unique=True)
 
 
 class FileMetadata(SQLModel, table=True):
@@ -42,4 +43,4 @@ class FileMetadata(SQLModel, table=True):
 class AdminPrompt(SQLModel, table=True):
     id: Optional[str] = Field(default_factory=lambda: str(uuid4()), primary_key=True)
     prompt: str
-    company_id: str = Field(foreign_key="company.id")
\ No newline at end of file
+    company_id: str = Field(foreign_key="company.id", unique=True)
\ No newline at end of file
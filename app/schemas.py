@@ -22,6 +22,9 @@ class RegisterResponse(BaseModel):
 
 class ChatRequest(BaseModel):
     question: str = Field(..., examples=["Расскажите кратко о вашей компании"])
+    stream: bool = Field(
+        False, description="Stream the answer as server-sent events"
+    )
 
 
 class ChatResponse(BaseModel):
@@ -34,6 +37,13 @@ class TaskResponse(BaseModel):
     monitoring_url: str
 
 
+class UploadResultResponse(BaseModel):
+    success: bool
+    company_id: str
+    errors: list[str]
+    details: dict
+
+
 class UploadResponse(BaseModel):
     status: dict[str, bool]
 
@@ -1,33 +1,67 @@
-from sqlmodel import Session, delete
+import asyncio
+from sqlmodel import delete
 from sqlalchemy.exc import SQLAlchemyError
 
 from app import logger
 from app.database import upload_documents, delete_documents
 from app.celery_worker import celery_tasks
 from app.models import Company, AdminPrompt
-from app.clients import engine
-from app.utils import send_webhook
-
-
-@celery_tasks.task
+from app.clients import create_session, create_search_client, get_sync_redis
+from app.utils import (
+    send_webhook,
+    get_company_cache_key,
+    get_prompt_cache_key,
+    get_semantic_cache_keys,
+    get_exact_cache_key,
+)
+
+
+async def run_with_search_client(func, *args, **kwargs):
+    """
+    Run an async database function with a search client bound to the current loop
+    """
+    async with create_search_client() as search_client:
+        return await func(*args, search_client=search_client, **kwargs)
+
+
+# Each run indexes the files under new document ids, so a redelivered upload
+# would index them twice
+@celery_tasks.task(acks_late=False)
 def upload_documents_task(
-    documents: list[dict], company_id: int, url: str
-) -> dict[str, bool]:
+    documents: list[dict], company_id: int, url: str | None
+) -> dict:
     result = {
         "success": False,
         "company_id": company_id,
         "errors": [],
         "details": {
             "documents_uploaded": False,
+            # Results of several files are merged, so each file is named
+            "files": [
+                {"file_name": data["file_name"], "document_id": None, "indexed": False}
+                for data in documents
+            ],
         },
     }
     try:
         logger.info(f"Uploading documents to company_id: {company_id}")
 
-        upload_documents(documents, company_id)
+        with create_session() as session:
+            uploaded = asyncio.run(
+                run_with_search_client(upload_documents, documents, company_id, session)
+            )
+        # Files that were indexed can change answers even if others failed
+        get_sync_redis().delete(
+            *get_semantic_cache_keys(company_id), get_exact_cache_key(company_id)
+        )
 
-        result["details"]["documents_uploaded"] = True
-        result["success"] = True
+        result["details"]["documents_uploaded"] = uploaded["indexed"]
+        if uploaded["files"]:
+            result["details"]["files"] = uploaded["files"]
+        if uploaded["indexed"]:
+            result["success"] = True
+        else:
+            result["errors"].append("Documents upload: some files were not indexed")
     except SQLAlchemyError as e:
         logger.error(f"Database error during upload for company {company_id}: {str(e)}")
         result["errors"].append(f"Database operation: {e}")
@@ -45,6 +79,39 @@ def upload_documents_task(
             logger.error(f"Webhook failed for company {company_id}: {str(e)}")
             result["errors"].append(f"Webhook: {str(e)}")
 
+    return result
+
+
+@celery_tasks.task
+def merge_upload_results(results: list[dict], company_id: int, url: str) -> dict:
+    """
+    Combine the results of an upload that ran a task per file, so the
+    upload sends one webhook and has one status
+    """
+    result = {
+        "success": all(file_result["success"] for file_result in results),
+        "company_id": company_id,
+        "errors": [error for file_result in results for error in file_result["errors"]],
+        "details": {
+            "documents_uploaded": all(
+                file_result["details"]["documents_uploaded"] for file_result in results
+            ),
+            "files": [
+                file
+                for file_result in results
+                for file in file_result["details"]["files"]
+            ],
+        },
+    }
+    try:
+        if url:
+            response = send_webhook(url=url, payload=result)
+            logger.info(f"Webhook sent for company {company_id}, {response.status_code}")
+    except Exception as e:
+        logger.error(f"Webhook failed for company {company_id}: {str(e)}")
+        result["errors"].append(f"Webhook: {str(e)}")
+
+    return result
 
 
 @celery_tasks.task
@@ -60,10 +127,19 @@ def delete_documents_task(company_id: int, url: str) -> dict[str, bool]:
 
     try:
         logger.info(f"Deleting documents to company_id: {company_id}")
-        delete_documents(company_id)
-
-        result["details"]["documents_deleted"] = True
-        result["success"] = True
+        with create_session() as session:
+            deleted = asyncio.run(
+                run_with_search_client(delete_documents, company_id, session)
+            )
+
+        result["details"]["documents_deleted"] = deleted["success"]
+        if deleted["success"]:
+            get_sync_redis().delete(
+                *get_semantic_cache_keys(company_id), get_exact_cache_key(company_id)
+            )
+            result["success"] = True
+        else:
+            result["errors"].append("Documents deletion failed")
     except SQLAlchemyError as e:
         logger.error(
             f"Critical error during deletion for company {company_id}: {str(e)}"
@@ -81,6 +157,7 @@ def delete_documents_task(company_id: int, url: str) -> dict[str, bool]:
             logger.error(f"Webhook failed for company {company_id}: {str(e)}")
             result["errors"].append(f"Webhook: {str(e)}")
 
+    return result
 
 
 @celery_tasks.task(max_retries=3, default_retry_delay=60)
@@ -97,15 +174,19 @@ def delete_company_task(company_id: str, url: str | None = None):
     }
 
     try:
-        try:
-            delete_documents(company_id)
-            result["details"]["documents_deleted"] = True
-        except Exception as e:
-            logger.error(f"Error deleting documents for company {company_id}: {str(e)}")
-            result["errors"].append(f"Documents deletion: {str(e)}")
+        with create_session() as session:
+            try:
+                deleted = asyncio.run(
+                    run_with_search_client(delete_documents, company_id, session)
+                )
+                result["details"]["documents_deleted"] = deleted["success"]
+            except Exception as e:
+                logger.error(
+                    f"Error deleting documents for company {company_id}: {str(e)}"
+                )
+                result["errors"].append(f"Documents deletion: {str(e)}")
 
-        try:
-            with Session(engine) as session:
+            try:
                 deleted_prompts = session.exec(
                     delete(AdminPrompt).where(AdminPrompt.company_id == company_id)
                 )
@@ -113,17 +194,24 @@ def delete_company_task(company_id: str, url: str | None = None):
 
                 company = session.get(Company, company_id)
                 if company:
+                    api_key = company.api_key
                     session.delete(company)
                     session.commit()
                     result["details"]["company_deleted"] = True
                     result["success"] = True
+                    get_sync_redis().delete(
+                        get_company_cache_key(api_key),
+                        *get_semantic_cache_keys(company_id),
+                        get_exact_cache_key(company_id),
+                        get_prompt_cache_key(company_id),
+                    )
                 else:
                     result["errors"].append("Company not found")
-        except SQLAlchemyError as e:
-            session.rollback()
-            logger.error(f"Database error for company {company_id}: {str(e)}")
-            result["errors"].append(f"Database operation: {str(e)}")
-            raise
+            except SQLAlchemyError as e:
+                session.rollback()
+                logger.error(f"Database error for company {company_id}: {str(e)}")
+                result["errors"].append(f"Database operation: {str(e)}")
+                raise
 
     except Exception as e:
         logger.exception(f"Critical error during deletion for company {company_id}")
@@ -137,3 +225,4 @@ def delete_company_task(company_id: str, url: str | None = None):
                 logger.error(f"Webhook failed for company {company_id}: {str(e)}")
                 result["errors"].append(f"Webhook: {str(e)}")
 
+    return result
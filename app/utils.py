@@ -1,24 +1,23 @@
+import asyncio
 import base64
-from openai.lib.azure import AzureOpenAI
+import hashlib
+import numpy as np
 from openai import APIError, RateLimitError, InternalServerError
 from pathlib import Path
-from typing import List, Union
+from typing import Iterator, List, Union
 import docx2txt
 from pypdf import PdfReader
-from app import logger, settings
-from uuid import uuid4
+from app import logger
+from app.config import get_app_settings
+from app.clients import get_embedding_client
 from fastapi import HTTPException
-import json
+import orjson
 from redis import asyncio as aioredis
+from redis.client import NEVER_DECODE
 import requests
 from io import BytesIO
 
-client = AzureOpenAI(
-    api_key=settings.api_key,
-    api_version=settings.embedding_model_api_version,
-    azure_endpoint=settings.embedding_model_url,
-)
-
+settings = get_app_settings()
 
 def get_embedding(text: str) -> List[float]:
     """
@@ -40,7 +39,7 @@ def get_embedding(text: str) -> List[float]:
 
     try:
         logger.info(f"Generating embedding for text of length {len(text)}")
-        response = client.embeddings.create(
+        response = get_embedding_client().embeddings.create(
             input=[text], model=settings.embedding_model_name
         )
         logger.info(
@@ -58,6 +57,187 @@ def get_embedding(text: str) -> List[float]:
         raise
 
 
+def get_question_digest(text: str) -> str:
+    """
+    Hash of the text with case and whitespace normalized
+    """
+    normalized = " ".join(text.lower().split())
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+async def get_cached_embedding(redis_client: aioredis.Redis, text: str) -> List[float]:
+    """
+    Get an embedding for the text, reusing the one cached in Redis for the
+    same normalized text. Cached vectors are stored as base64 float32.
+    """
+    digest = get_question_digest(text)
+    key = f"embedding:{settings.embedding_model_name}:{digest}"
+
+    try:
+        cached = await redis_client.get(key)
+        if cached:
+            logger.debug("Embedding cache hit for {}", digest)
+            return np.frombuffer(base64.b64decode(cached), dtype=np.float32).tolist()
+    except aioredis.RedisError as re:
+        logger.warning(f"Embedding cache is unavailable: {str(re)}")
+
+    embedding = await asyncio.to_thread(get_embedding, text)
+
+    try:
+        await redis_client.set(
+            key,
+            base64.b64encode(np.asarray(embedding, dtype=np.float32).tobytes()),
+            ex=settings.embedding_cache_ttl,
+        )
+    except aioredis.RedisError as re:
+        logger.warning(f"Failed to cache embedding: {str(re)}")
+    return embedding
+
+
+def get_semantic_cache_keys(company_id: str) -> tuple[str, str]:
+    """
+    Keys of the cached answers and of their packed question embeddings
+    """
+    return f"semantic_answers:{company_id}", f"semantic_vectors:{company_id}"
+
+
+def get_exact_cache_key(company_id: str) -> str:
+    return f"exact_cache:{company_id}"
+
+
+async def get_exact_cache_answer(
+    redis_client: aioredis.Redis, company_id: str, question: str
+) -> str | None:
+    """
+    Find a cached answer to the same question, skipping the semantic lookup
+    """
+    try:
+        answer = await redis_client.hget(
+            get_exact_cache_key(company_id), get_question_digest(question)
+        )
+        if answer is not None:
+            logger.info(f"Exact cache hit for company {company_id}")
+        return answer
+    except aioredis.RedisError as re:
+        logger.warning(f"Exact cache is unavailable: {str(re)}")
+    return None
+
+
+async def get_semantic_cache_answer(
+    redis_client: aioredis.Redis, company_id: str, embedding: List[float]
+) -> str | None:
+    """
+    Find a cached answer to a question similar to the one with this embedding.
+
+    Cached embeddings are read as one float32 matrix, a row per answer slot.
+    """
+    answers_key, vectors_key = get_semantic_cache_keys(company_id)
+    try:
+        # The client decodes responses, the matrix is binary
+        vectors = await redis_client.execute_command(
+            "GET", vectors_key, **{NEVER_DECODE: True}
+        )
+        if not vectors:
+            return None
+
+        query = np.asarray(embedding, dtype=np.float32)
+        if len(vectors) % query.nbytes:
+            logger.warning(f"Semantic cache of company {company_id} has another dimension")
+            return None
+
+        vectors = np.frombuffer(vectors, dtype=np.float32).reshape(-1, query.size)
+        similarities = vectors @ (query / np.linalg.norm(query))
+        best = int(similarities.argmax())
+        if similarities[best] < settings.semantic_cache_threshold:
+            return None
+
+        answer = await redis_client.hget(answers_key, str(best))
+        if answer is not None:
+            logger.info(
+                f"Semantic cache hit for company {company_id}, similarity {similarities[best]:.3f}"
+            )
+        return answer
+
+    except aioredis.RedisError as re:
+        logger.warning(f"Semantic cache is unavailable: {str(re)}")
+    except Exception as e:
+        logger.error(f"Error reading semantic cache: {str(e)}", exc_info=True)
+    return None
+
+
+async def add_semantic_cache_answer(
+    redis_client: aioredis.Redis,
+    company_id: str,
+    question: str,
+    embedding: List[float],
+    answer: str,
+) -> None:
+    """
+    Cache an answer with the normalized embedding of its question and the
+    question's digest. Answers take `semantic_cache_size` slots in turn, so
+    the oldest one is overwritten and dropped from the exact lookups too.
+    """
+    answers_key, vectors_key = get_semantic_cache_keys(company_id)
+    exact_key = get_exact_cache_key(company_id)
+    query = np.asarray(embedding, dtype=np.float32)
+    digest = get_question_digest(question)
+
+    try:
+        slot = (
+            await redis_client.hincrby(answers_key, "next", 1) - 1
+        ) % settings.semantic_cache_size
+        replaced_digest = await redis_client.hget(answers_key, f"digest:{slot}")
+        # The embedding and its answer are replaced together, slots past the
+        # end of the matrix are zero-filled and never match
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.setrange(
+                vectors_key, slot * query.nbytes, (query / np.linalg.norm(query)).tobytes()
+            )
+            pipe.hset(answers_key, mapping={str(slot): answer, f"digest:{slot}": digest})
+            pipe.expire(vectors_key, settings.semantic_cache_ttl)
+            pipe.expire(answers_key, settings.semantic_cache_ttl)
+            if replaced_digest and replaced_digest != digest:
+                pipe.hdel(exact_key, replaced_digest)
+            pipe.hset(exact_key, digest, answer)
+            pipe.expire(exact_key, settings.semantic_cache_ttl)
+            await pipe.execute()
+    except aioredis.RedisError as re:
+        logger.warning(f"Failed to cache answer: {str(re)}")
+
+
+async def clear_semantic_cache(redis_client: aioredis.Redis, company_id: str) -> None:
+    """
+    Drop cached answers after the company's documents or prompt change
+    """
+    try:
+        await redis_client.delete(
+            *get_semantic_cache_keys(company_id), get_exact_cache_key(company_id)
+        )
+    except aioredis.RedisError as re:
+        logger.warning(f"Failed to clear semantic cache: {str(re)}")
+
+
+def get_embeddings(texts: List[str]) -> List[List[float]]:
+    """
+    Generate embeddings for several texts with one API request.
+
+    Returns:
+        List[List[float]]: Embeddings in the same order as the input texts.
+    Raises:
+        RuntimeError: If embedding generation fails
+    """
+    try:
+        logger.info(f"Generating embeddings for {len(texts)} texts")
+        response = get_embedding_client().embeddings.create(
+            input=texts, model=settings.embedding_model_name
+        )
+        return [item.embedding for item in sorted(response.data, key=lambda d: d.index)]
+
+    except (APIError, RateLimitError, InternalServerError) as e:
+        logger.error(f"Embedding generation failed: {str(e)}", exc_info=True)
+        raise RuntimeError(f"Embedding generation failed: {str(e)}") from e
+
+
 def chunk_text(text: str, size: int = 1000) -> List[str]:
     """
     Split the input text into chunks with validation
@@ -88,7 +268,9 @@ def extract_text_from_pdf(content: bytes) -> str:
         for page_num, page in enumerate(reader.pages, 1):
             page_text = page.extract_text() or ""
             text += page_text
-            logger.debug(f"Extracted {len(page_text)} characters from page {page_num}")
+            logger.debug(
+                "Extracted {} characters from page {}", len(page_text), page_num
+            )
 
         cleaned_text = text.strip()
         logger.info(f"Successfully extracted {len(cleaned_text)} characters from PDF")
@@ -145,9 +327,14 @@ def extract_text(file_content: bytes, file_name: str) -> str:
         raise ValueError(f"Text extraction failed: {str(e)}") from e
 
 
-def create_batch(company_id: str, file_content: bytes, file_name: str, document_id: str) -> List[dict]:
+def create_batch(
+    company_id: str, file_content: bytes, file_name: str, document_id: str
+) -> Iterator[List[dict]]:
     """
-    Create document batch with comprehensive error handling
+    Create document batches with comprehensive error handling.
+
+    Chunks are yielded in groups of `embedding_batch_size` right after they
+    are embedded, so only one group of embeddings is held in memory.
     """
     logger.info(f"Creating batch for company {company_id}, document {document_id}")
 
@@ -166,30 +353,53 @@ def create_batch(company_id: str, file_content: bytes, file_name: str, document_
         chunks = chunk_text(text, int(settings.embedding_model_size))
         logger.info(f"Created {len(chunks)} chunks for document {file_name}")
 
-        batch = []
+        # Whitespace-only chunks can't be embedded. Repeated chunks (headers,
+        # footers, boilerplate) are embedded and indexed once per document.
+        seen = set()
+        indexed_chunks = []
         for i, chunk in enumerate(chunks):
+            if not chunk.strip():
+                continue
+            digest = hashlib.blake2b(chunk.strip().encode(), digest_size=16).digest()
+            if digest not in seen:
+                seen.add(digest)
+                indexed_chunks.append((i, chunk))
+        if len(indexed_chunks) < len(chunks):
+            logger.info(
+                f"Skipped {len(chunks) - len(indexed_chunks)} empty or repeated chunks in {file_name}"
+            )
+        batch_size = settings.embedding_batch_size
+
+        created = 0
+        for start in range(0, len(indexed_chunks), batch_size):
+            embedding_batch = indexed_chunks[start : start + batch_size]
             try:
-                emb = get_embedding(chunk)
-                doc_id = f"{company_id}-{uuid4()}"
-
-                batch.append(
-                    {
-                        "id": doc_id,
-                        "company_id": company_id,
-                        "document_id": document_id,
-                        "content": str(chunk),
-                        "embedding": emb,
-                    }
-                )
-                logger.debug(
-                    f"Created chunk {i+1}/{len(chunks)} for document {document_id}"
+                embeddings = get_embeddings(
+                    [chunk.strip() for _, chunk in embedding_batch]
                 )
-
             except Exception as e:
-                logger.error(f"Failed to process chunk {i+1}: {str(e)}", exc_info=True)
-
-        logger.info(f"Successfully created batch with {len(batch)} documents")
-        return batch
+                logger.error(
+                    f"Failed to process chunks {start + 1}-{start + len(embedding_batch)}: {str(e)}",
+                    exc_info=True,
+                )
+                continue
+
+            # document_id is already unique, so the chunk index is enough
+            batch = [
+                {
+                    "id": f"{company_id}-{document_id}-{i}",
+                    "company_id": company_id,
+                    "document_id": document_id,
+                    "content": chunk,
+                    "embedding": emb,
+                }
+                for (i, chunk), emb in zip(embedding_batch, embeddings)
+            ]
+            created += len(batch)
+            logger.debug("Created {} chunks for document {}", len(batch), document_id)
+            yield batch
+
+        logger.info(f"Successfully created batch with {created} documents")
 
     except ValueError as ve:
         logger.error(f"Value error during batch creation: {str(ve)}")
@@ -208,14 +418,25 @@ def encode_document_key(key: str) -> str:
         raise TypeError("Key must be a string")
 
     try:
-        encoded = base64.urlsafe_b64encode(key.encode()).decode("utf-8")
-        logger.debug(f"Encoded document key: {key[:10]}... -> {encoded[:10]}...")
+        encoded = base64.urlsafe_b64encode(key.encode()).decode("ascii")
+        logger.debug("Encoded document key: {:.10}... -> {:.10}...", key, encoded)
         return encoded
     except Exception as e:
         logger.error(f"Error encoding document key: {str(e)}", exc_info=True)
         raise ValueError(f"Document key encoding failed: {str(e)}") from e
 
 
+def get_company_cache_key(api_key: str) -> str:
+    """
+    Redis key of a cached company, the API key itself is not stored
+    """
+    return f"company:{hashlib.blake2b(api_key.encode(), digest_size=16).hexdigest()}"
+
+
+def get_prompt_cache_key(company_id: str) -> str:
+    return f"admin_prompt:{company_id}"
+
+
 async def get_redis_history(redis_client: aioredis.Redis, key: str) -> list:
     """
     Get chat history from Redis with error handling
@@ -230,7 +451,7 @@ async def get_redis_history(redis_client: aioredis.Redis, key: str) -> list:
 
         if history:
             logger.info(f"Retrieved {len(history)} history items from Redis")
-            return [json.loads(msg) for msg in history]
+            return [orjson.loads(msg) for msg in history]
 
         logger.info("No history found in Redis")
         return []
@@ -244,7 +465,7 @@ async def get_redis_history(redis_client: aioredis.Redis, key: str) -> list:
 
 
 async def set_redis_history(
-    redis_client: aioredis.Redis, key: str, *values: str
+    redis_client: aioredis.Redis, key: str, *values: str | bytes
 ) -> None:
     """
     Set chat history in Redis with error handling
@@ -259,8 +480,12 @@ async def set_redis_history(
 
     try:
         logger.debug(f"Saving {len(values)} items to Redis history")
-        await redis_client.rpush(key, *values)
-        await redis_client.ltrim(key, -10, -1)
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.rpush(key, *values)
+            pipe.ltrim(key, -10, -1)
+            # History outlives its session only until the session would expire
+            pipe.expire(key, settings.session_ttl)
+            await pipe.execute()
         logger.info(f"Successfully saved {len(values)} items to Redis history")
 
     except aioredis.RedisError as re:
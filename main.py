@@ -1,10 +1,18 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from contextlib import asynccontextmanager
 from app.endpoints import router
 from app import logger
 from sqlmodel import SQLModel
-from app.clients import engine
+from sqlalchemy.exc import SQLAlchemyError
+from app.clients import (
+    get_engine,
+    get_redis,
+    get_azure_client,
+    get_deepseek_client,
+    create_search_client,
+)
 
 app = FastAPI(
     title="Ycla AI API",
@@ -22,11 +30,24 @@ app.add_middleware(
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    SQLModel.metadata.create_all(engine)
-    logger.success("Server is starting up.")
-    yield
+    SQLModel.metadata.create_all(get_engine())
+    async with create_search_client() as search_client:
+        app.state.search_client = search_client
+        logger.success("Server is starting up.")
+        yield
+    if get_redis.cache_info().currsize:
+        await get_redis().connection_pool.disconnect()
+    for get_llm_client in (get_azure_client, get_deepseek_client):
+        if get_llm_client.cache_info().currsize:
+            await get_llm_client().close()
     logger.warning("Server is shutting down.")
 
 
+@app.exception_handler(SQLAlchemyError)
+async def database_error_handler(request: Request, exc: SQLAlchemyError):
+    logger.error(f"Database error on {request.url.path}: {exc}")
+    return JSONResponse(status_code=500, content={"detail": "Database operation error"})
+
+
 app.router.lifespan_context = lifespan
 app.include_router(router)
@@ -0,0 +1,65 @@
+"""Unique admin prompt per company
+
+Revision ID: 3b1f6c2d9a47
+Revises: fae691487b2f
+Create Date: 2025-06-20 12:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '3b1f6c2d9a47'
+down_revision: Union[str, None] = 'fae691487b2f'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+CONSTRAINT_NAME = "adminprompt_company_id_key"
+
+
+def _has_constraint() -> bool:
+    inspector = sa.inspect(op.get_bind())
+    return any(
+        constraint["name"] == CONSTRAINT_NAME
+        for constraint in inspector.get_unique_constraints("adminprompt")
+    )
+
+
+def upgrade() -> None:
+    """Upgrade schema."""
+    bind = op.get_bind()
+    # Tables are created by the app on startup, new databases get the
+    # constraint from the model. SQLite databases are local development ones
+    # and can't add a constraint to an existing table, so they are left as is
+    if (
+        bind.dialect.name != "postgresql"
+        or not sa.inspect(bind).has_table("adminprompt")
+        or _has_constraint()
+    ):
+        return
+
+    # Keep one prompt per company before enforcing uniqueness. Prompts have no
+    # timestamp, so which one survives is arbitrary (the greatest random id),
+    # not necessarily the latest one saved
+    op.execute(
+        """
+        DELETE FROM adminprompt a
+        USING adminprompt b
+        WHERE a.company_id = b.company_id AND a.id < b.id
+        """
+    )
+    op.create_unique_constraint(CONSTRAINT_NAME, "adminprompt", ["company_id"])
+
+
+def downgrade() -> None:
+    """Downgrade schema."""
+    bind = op.get_bind()
+    if (
+        bind.dialect.name == "postgresql"
+        and sa.inspect(bind).has_table("adminprompt")
+        and _has_constraint()
+    ):
+        op.drop_constraint(CONSTRAINT_NAME, "adminprompt", type_="unique")